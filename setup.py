@@ -3,7 +3,7 @@ import re
 
 from setuptools import find_packages, setup
 
-regexp = re.compile(r".*__version__ = [\'\"](.*?)[\'\"]", re.S)
+regexp = re.compile(r"__version__\s*=\s*[\'\"]([^\'\"]+)[\'\"]")
 
 
 init_file = os.path.join(
@@ -11,7 +11,7 @@ init_file = os.path.join(
 )
 with open(init_file, "r") as f:  # pylint: disable=unspecified-encoding
     module_content = f.read()
-    match = regexp.match(module_content)
+    match = regexp.search(module_content)
     if match:
         version = match.group(1)
     else:
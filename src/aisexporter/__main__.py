@@ -107,7 +107,8 @@ def main():
     if args.latitude and args.longitude:
         args.origin = (args.latitude, args.longitude)
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     mon = aisexporter(
         resource_path=args.resource_path,
         host=args.host,
@@ -4,14 +4,15 @@ Prometheus.io monitoring server for aggregation and later visualisation.
 """
 
 import asyncio
-import datetime
-import json
 import logging
 import math
-from math import asin, atan, cos, degrees, radians, sin, sqrt
-from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+from collections import Counter
+from math import atan2, cos, degrees, radians, sin, sqrt
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import aiohttp
+import numpy as np
+import orjson
 from aioprometheus import Gauge
 from aioprometheus.service import Service
 
@@ -23,6 +24,19 @@ MetricsSpecGroupType = Sequence[MetricSpecItemType]
 
 logger = logging.getLogger(__name__)
 
+# column indices of the fields used from a ships_array.json row
+MMSI_IDX = 0
+LAT_IDX = 1
+LON_IDX = 2
+COUNTRY_IDX = 22
+NAME_IDX = 31
+SEEN_IDX = 33  # seconds since the ship was last heard
+
+# upper bounds, in meters, of the ship range buckets. The counts are gauges
+# labelled within_meters rather than histogram buckets, so there is no +Inf
+# bucket; observed_with_pos counts every ship that has a position.
+RANGE_BUCKETS = (1e3, 2e3, 5e3, 10e3, 20e3, 50e3, 100e3, 200e3)
+
 shipsKeys = (
     "altitude",
     "category",
@@ -83,36 +97,10 @@ def relative_angle(pos1: Position, pos2: Position) -> float:
     :returns: angle in degrees
     :rtype: float
     """
-    lat1, lon1, lat2, lon2 = [
-        x for x in (*pos1, *pos2)  # pylint: disable=unnecessary-comprehension
-    ]
-
-    # Special case - same lat as origin: 90 degrees or 270 degrees
-    #
-    #    |
-    # -x-o-x-
-    #    |
-
-    if lat2 == lat1:
-        if lon2 > lon1:
-            return 90
-        else:
-            return 270
-
-    deg = degrees(atan((lon2 - lon1) / (lat2 - lat1)))
-
-    # Sign of results from the calculation above
-    #
-    #  - | +  (lat2>lat1)
-    # ---o---
-    #  + | -  (lat2<lat1)
-    #
-    # conversion needed to express in terms of 360 degrees
-
-    if lat2 > lat1:
-        return (360 + deg) % 360
-    else:
-        return 180 + deg
+    # atan2 resolves the quadrant itself, including targets due east or
+    # west of the origin, so no special cases are required.
+    deg = degrees(atan2(pos2.longitude - pos1.longitude, pos2.latitude - pos1.latitude))
+    return deg % 360
 
 
 # lookup table for directions - each step is 22.5 degrees
@@ -140,7 +128,81 @@ def relative_direction(angle: float) -> str:
     """
     Convert relative angle in degrees into direction (N/NE/E/SE/S/SW/W/NW)
     """
-    return direction_lut[int(angle / 22.5)]
+    # multiply by the reciprocal of 22.5 and mask, which also wraps 360 to N
+    return direction_lut[int(angle * (16 / 360)) & 15]
+
+
+def relative_direction_from_pos(pos1: Position, pos2: Position) -> str:
+    """
+    Return the direction (N/NE/E/SE/S/SW/W/NW) of pos2 relative to pos1.
+
+    This is equivalent to ``relative_direction(relative_angle(pos1, pos2))``
+    but works directly on the atan2 result in radians. process_ships
+    classifies whole batches with :func:`relative_direction_vector`; this
+    scalar form serves single positions and is the reference the vector
+    classifier is tested against.
+
+    :param pos1: a Position tuple defining (lat, lon) of origin in decimal degrees
+    :param pos2: a Position tuple defining (lat, lon) of target in decimal degrees
+    """
+    angle = atan2(pos2.longitude - pos1.longitude, pos2.latitude - pos1.latitude)
+    # angle is in [-pi, pi]; shifting by a full turn of 16 steps keeps the
+    # value positive so that truncation and masking select the correct step.
+    return direction_lut[int(angle * (8 / math.pi) + 16) & 15]
+
+
+# compass points in clockwise order, each covering a 45 degree sector
+compass_points = ("N", "NE", "E", "SE", "S", "SW", "W", "NW")
+
+# metric labels built once and reused on every update
+latest_labels = {"time_period": "latest"}
+range_labels = tuple(
+    {"time_period": "latest", "within_meters": f"{bound:g}"}
+    for bound in RANGE_BUCKETS
+)
+direction_labels = tuple(
+    {"time_period": "latest", "direction": direction} for direction in compass_points
+)
+
+# sector boundaries expressed as |dlon| / |dlat| ratios so that directions
+# can be classified without any trigonometric calls per ship.
+_TAN_22_5 = math.tan(math.radians(22.5))
+_TAN_67_5 = math.tan(math.radians(67.5))
+
+
+def relative_direction_vector(
+        lats1: Union[float, np.ndarray],
+        lons1: Union[float, np.ndarray],
+        lats2: Union[float, np.ndarray],
+        lons2: Union[float, np.ndarray],
+) -> np.ndarray:
+    """
+    Classify the direction of many points (lats2, lons2) relative to
+    (lats1, lons1). This is the array equivalent of combining
+    :func:`relative_angle` and :func:`relative_direction`.
+
+    :returns: array of indices into :data:`compass_points`.
+    :rtype: np.ndarray
+    """
+    dlat = np.asarray(lats2) - lats1
+    dlon = np.asarray(lons2) - lons1
+    abs_dlat = np.abs(dlat)
+    abs_dlon = np.abs(dlon)
+
+    # number of 45 degree steps away from the north/south axis. Strict
+    # comparisons keep a point at the origin (dlat == dlon == 0) at N, which
+    # matches atan2(0, 0) == 0 in the scalar functions.
+    steps = (abs_dlon > abs_dlat * _TAN_22_5).astype(np.intp)
+    steps += abs_dlon > abs_dlat * _TAN_67_5
+
+    north = dlat >= 0
+    east = dlon >= 0
+    index = np.where(
+        north,
+        np.where(east, steps, (8 - steps) % 8),
+        np.where(east, 4 - steps, 4 + steps),
+    )
+    return index
 
 
 def haversine_distance(
@@ -164,13 +226,55 @@ def haversine_distance(
     :returns: distance between two points in meters.
     :rtype: float
     """
-    lat1, lon1, lat2, lon2 = [radians(x) for x in (*pos1, *pos2)]
+    lat1 = radians(pos1.latitude)
+    lon1 = radians(pos1.longitude)
+    lat2 = radians(pos2.latitude)
+    lon2 = radians(pos2.longitude)
 
     hav = (
             sin((lat2 - lat1) / 2.0) ** 2
             + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2.0) ** 2
     )
-    distance = 2 * radius * asin(sqrt(hav))
+    distance = 2 * radius * atan2(sqrt(hav), sqrt(1.0 - hav))
+    return distance
+
+
+def haversine_vector(
+        lats1: Union[float, np.ndarray],
+        lons1: Union[float, np.ndarray],
+        lats2: Union[float, np.ndarray],
+        lons2: Union[float, np.ndarray],
+        *,
+        radius: float = 6371.0e3,
+        cos_lats1: Optional[Union[float, np.ndarray]] = None,
+) -> np.ndarray:
+    """
+    Calculate the distances between many pairs of points on a sphere.
+
+    This is the array equivalent of :func:`haversine_distance`. The inputs
+    are arrays (or scalars, which are broadcast) of decimal degrees and the
+    whole batch is computed in a single pass.
+
+    :param lats1: latitudes of the first points in decimal degrees
+    :param lons1: longitudes of the first points in decimal degrees
+    :param lats2: latitudes of the second points in decimal degrees
+    :param lons2: longitudes of the second points in decimal degrees
+    :param radius: radius of sphere in meters.
+    :param cos_lats1: optional precomputed cosine of the first latitudes,
+      useful when the first point is a fixed origin.
+
+    :returns: array of distances between the point pairs in meters.
+    :rtype: np.ndarray
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lats1, lons1, lats2, lons2))
+    if cos_lats1 is None:
+        cos_lats1 = np.cos(lat1)
+
+    hav = (
+            np.sin((lat2 - lat1) / 2.0) ** 2
+            + cos_lats1 * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    )
+    distance = 2 * radius * np.arctan2(np.sqrt(hav), np.sqrt(1.0 - hav))
     return distance
 
 
@@ -190,28 +294,46 @@ def create_gauge_metric(label: str, doc: str, prefix: str = "") -> Gauge:
     return gauge
 
 
+def range_bucket_counts(
+        distances: np.ndarray, bounds: Sequence[float] = RANGE_BUCKETS
+) -> np.ndarray:
+    """Count the distances that fall within each range bound
+
+    The counts are cumulative, like Prometheus histogram buckets: the count
+    for a bound includes every distance less than or equal to it.
+
+    :param distances: an array of distances in meters.
+    :param bounds: the sorted upper bounds of the buckets in meters.
+
+    :returns: an array holding the count for each bound.
+    """
+    return np.searchsorted(np.sort(distances), bounds, side="right")
+
+
 async def _fetch(
+        session: aiohttp.ClientSession,
         resource: str,
-        timeout: float = 2.0
 ) -> Dict[Any, Any]:
-    """Fetch JSON data from a web or file resource and return a dict"""
+    """Fetch JSON data from a web or file resource and return a dict
+
+    :param session: the HTTP client session used to fetch web resources.
+      Request timeouts are configured on the session.
+    :param resource: a web address or file system path.
+    """
     logger.debug(f"fetching {resource}")
     if resource.startswith("http"):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                        resource, timeout=timeout
-                ) as resp:
-                    if not resp.status == 200:
-                        raise Exception(f"Fetch failed {resp.status}: {resource}")
-                    data = await resp.json()
+            async with session.get(resource) as resp:
+                if not resp.status == 200:
+                    raise Exception(f"Fetch failed {resp.status}: {resource}")
+                data = orjson.loads(await resp.read())  # pylint: disable=no-member
         except asyncio.TimeoutError:
             raise Exception(f"Request timed out to {resource}") from None
         except aiohttp.ClientError as exc:
             raise Exception(f"Client error {exc}, {resource}") from None
     else:
-        with open(resource, "rt") as fd:  # pylint: disable=unspecified-encoding
-            data = json.loads(fd.read())
+        with open(resource, "rb") as fd:
+            data = orjson.loads(fd.read())  # pylint: disable=no-member
 
     return data
 
@@ -251,29 +373,33 @@ class aisexporter:
         :param origin: a tuple of (lat, lon) representing the receiver
           location. The origin is used for distance calculations with
           ships data. If it is not provided then range calculations
-          can not be performed and the maximum range metric will always
-          be zero.
+          can not be performed and the range metrics are not exported.
         :param fetch_timeout: The number of seconds to wait for a response
           from ais.
         """
         self.resources = build_resources(resource_path)
-        self.loop = asyncio.get_event_loop()
         self.host = host
         self.port = port
         self.prefix = "ais_"
-        self.ships_interval = datetime.timedelta(seconds=ships_interval)
-        self.stats_interval = datetime.timedelta(seconds=stats_interval)
+        self.ships_interval = float(ships_interval)
+        self.stats_interval = float(stats_interval)
         self.stats_time_periods = time_periods
         self.origin = Position(*origin) if origin else None
+        if self.origin:
+            # origin term reused by every range calculation
+            self._cos_olat = math.cos(math.radians(self.origin.latitude))
         self.fetch_timeout = fetch_timeout
         self.svr = Service()
+        self.session = None  # type: Optional[aiohttp.ClientSession]
         self.stats_task = None  # type: Optional[asyncio.Task]
         self.ships_task = None  # type: Optional[asyncio.Task]
         self.knowledge_base = None
+        # country -> labels for the observed_by_country metric
+        self._country_labels = {}  # type: Dict[str, Dict[str, str]]
         self.initialise_metrics()
         logger.info(f"Monitoring ais resources at: {self.resources.base}")
         logger.info(
-            f"Refresh rates: ships={self.ships_interval}, statstics={self.stats_interval}"
+            f"Refresh rates: ships={self.ships_interval}s, statstics={self.stats_interval}s"
         )
         logger.info(f"Origin: {self.origin}")
 
@@ -282,6 +408,11 @@ class aisexporter:
         await self.svr.start(addr=self.host, port=self.port)
         logger.info(f"serving ais prometheus metrics on: {self.svr.metrics_url}")
 
+        # A single session keeps its connection pool across fetches
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.fetch_timeout)
+        )
+
         # fmt: off
         self.stats_task = asyncio.ensure_future(self.updater_stats())  # type: ignore
         self.ships_task = asyncio.ensure_future(self.updater_ships())  # type: ignore
@@ -306,6 +437,10 @@ class aisexporter:
                 pass
             self.ships_task = None
 
+        if self.session:
+            await self.session.close()
+            self.session = None
+
         await self.svr.stop()
 
     def initialise_metrics(self) -> None:
@@ -340,17 +475,20 @@ class aisexporter:
         This long running coroutine task is responsible for fetching current
         statistics from ais and then updating internal metrics.
         """
+        session = self.session
+        if session is None:
+            raise RuntimeError("The exporter must be started before updating")
+        loop = asyncio.get_running_loop()
         while True:
-            start = datetime.datetime.now()
+            start = loop.time()
             try:
-                stats = await _fetch(self.resources.stats)
+                stats = await _fetch(session, self.resources.stats)
                 self.process_stats(stats, time_periods=self.stats_time_periods)
             except Exception as exc:  # pylint: disable=broad-except
                 logger.error(f"Error fetching ais stats data: {exc}")
 
             # wait until next collection time
-            end = datetime.datetime.now()
-            wait_seconds = (start + self.stats_interval - end).total_seconds()
+            wait_seconds = max(0.0, start + self.stats_interval - loop.time())
             await asyncio.sleep(wait_seconds)
 
     async def updater_ships(self) -> None:
@@ -358,17 +496,20 @@ class aisexporter:
         This long running coroutine task is responsible for fetching current
         statistics from ais and then updating internal metrics.
         """
+        session = self.session
+        if session is None:
+            raise RuntimeError("The exporter must be started before updating")
+        loop = asyncio.get_running_loop()
         while True:
-            start = datetime.datetime.now()
+            start = loop.time()
             try:
-                ships = await _fetch(self.resources.ships)
+                ships = await _fetch(session, self.resources.ships)
                 self.process_ships(ships)
             except Exception as exc:  # pylint: disable=broad-except
                 logger.exception(f"Error fetching ais ships data")
 
             # wait until next collection time
-            end = datetime.datetime.now()
-            wait_seconds = (start + self.ships_interval - end).total_seconds()
+            wait_seconds = max(0.0, start + self.ships_interval - loop.time())
             await asyncio.sleep(wait_seconds)
 
     def process_stats(
@@ -409,28 +550,116 @@ class aisexporter:
         #                 value = math.nan
         #             metric.set(labels, value)
 
-    def process_ships(self, ships: dict, threshold: int = 15) -> None:
+    def haversine_from_origin(
+            self, lats: np.ndarray, lons: np.ndarray, radius: float = 6371.0e3
+    ) -> np.ndarray:
+        """Calculate the distance of positions from the origin.
+
+        This calls :func:`haversine_vector` with the origin as the first
+        point, passing the cosine of the origin latitude computed at start up.
+
+        :param lats: latitudes in decimal degrees, as a scalar or an array.
+        :param lons: longitudes in decimal degrees, as a scalar or an array.
+        :param radius: radius of sphere in meters.
+
+        :returns: distances from the origin in meters.
+        """
+        return haversine_vector(
+            self.origin.latitude,
+            self.origin.longitude,
+            lats,
+            lons,
+            radius=radius,
+            cos_lats1=self._cos_olat,
+        )
+
+    def ship_ranges(
+            self, lats: Sequence[float], lons: Sequence[float]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the distance and direction of ships relative to the origin.
+
+        The ship positions are passed as separate latitude and longitude
+        columns so that all of the work is performed on arrays.
+
+        :param lats: ship latitudes in decimal degrees.
+        :param lons: ship longitudes in decimal degrees.
+
+        :returns: a tuple of arrays holding distances in meters and indices
+          into :data:`compass_points`.
+        """
+        lat_col = np.asarray(lats, dtype=np.float64)
+        lon_col = np.asarray(lons, dtype=np.float64)
+        distances = self.haversine_from_origin(lat_col, lon_col)
+        directions = relative_direction_vector(
+            self.origin.latitude, self.origin.longitude, lat_col, lon_col
+        )
+        return distances, directions
+
+    def process_ships(self, ships: dict, threshold: int = 180) -> None:
         """Process ships statistics into exported metrics.
 
         :param ships: a dict containing ships data.
         :param threshold: only let ships seen within this threshold to
-          contribute to the metrics.
+          contribute to the metrics. Defaults to 180 seconds, the longest
+          reporting interval of ships at anchor or using class B equipment.
         """
-
-
         d = self.metrics["ships"]
+
+        # Only aggregates are exported. Per ship labels such as mmsi or
+        # name would create a new time series for every ship ever seen.
+        # ship positions are collected as columns for the range calculations
+        observed = 0
+        lats = []  # type: List[float]
+        lons = []  # type: List[float]
+        countries = Counter()  # type: Counter
         for a in ships["values"]:
-            ship_data = {
-                "mmsi": a[0],
-                "name": a[31],
-                "country": a[22],
-            }
-            if a[1] is None or a[2] is None:
+            if a[SEEN_IDX] > threshold:
                 continue
-            d["lat"].set(ship_data, a[1])
-            d["lon"].set(ship_data, a[2])
-
+            observed += 1
+            countries[a[COUNTRY_IDX] or "unknown"] += 1
+            lat, lon = a[LAT_IDX], a[LON_IDX]
+            if lat is None or lon is None:
+                continue
+            lats.append(lat)
+            lons.append(lon)
+        positioned = len(lats)
+
+        d["observed"].set(latest_labels, observed)
+        d["observed_with_pos"].set(latest_labels, positioned)
+
+        # drop countries that are no longer observed
+        d["observed_by_country"].values.clear()
+        country_labels = self._country_labels
+        for country, count in countries.items():
+            labels = country_labels.get(country)
+            if labels is None:
+                labels = {"time_period": "latest", "country": country}
+                country_labels[country] = labels
+            d["observed_by_country"].set(labels, count)
+
+        # ranges are unknown, rather than zero, without a receiver origin
+        if not self.origin:
+            logger.debug(f"ships: observed={observed}, with_pos={positioned}")
+            return
+
+        direction_ranges = np.zeros(len(compass_points))
+        range_counts = np.zeros(len(RANGE_BUCKETS), dtype=np.intp)
+        if positioned:
+            distances, directions = self.ship_ranges(lats, lons)
+            np.maximum.at(direction_ranges, directions, distances)
+            range_counts = range_bucket_counts(distances)
+        max_range = float(direction_ranges.max())
+        d["max_range"].set(latest_labels, max_range)
+
+        for direction_label, direction_range in zip(
+                direction_labels, direction_ranges.tolist()
+        ):
+            d["max_range_by_direction"].set(direction_label, direction_range)
+
+        for range_label, range_count in zip(range_labels, range_counts.tolist()):
+            d["observed_by_range"].set(range_label, range_count)
 
         logger.debug(
-            f"ships: observed={len(ships)}, "
+            f"ships: observed={observed}, "
+            f"with_pos={positioned}, max_range={max_range:.0f}"
         )
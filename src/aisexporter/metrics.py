@@ -48,16 +48,21 @@ To extract the totals since the ais application started:
 
 Specs = {
     "ships": (
-        # (
-        #     "observed",
-        #     "recent_ships_observed",
-        #     "Number of ships recently observed",
-        # ),
-        # (
-        #     "observed_with_pos",
-        #     "recent_ships_with_position",
-        #     "Number of ships recently observed with position",
-        # ),
+        (
+            "observed",
+            "recent_ships_observed",
+            "Number of ships recently observed",
+        ),
+        (
+            "observed_with_pos",
+            "recent_ships_with_position",
+            "Number of ships recently observed with position",
+        ),
+        (
+            "observed_by_country",
+            "recent_ships_observed_by_country",
+            "Number of ships recently observed by flag country",
+        ),
         # (
         #     "observed_with_direction",
         #     "recent_ships_with_direction",
@@ -68,41 +73,31 @@ Specs = {
         #     "recent_ships_with_multilateration",
         #     "Number of ships recently observed with multilateration",
         # ),
-        # (
-        #     "max_range",
-        #     "recent_ships_max_range",
-        #     "Maximum range of recently observed ships",
-        # ),
-        # (
-        #     "max_range_by_direction",
-        #     "recent_ships_max_range_by_direction",
-        #     "Maximum range of recently observed ships by direction relative to receiver",
-        # ),
+        (
+            "max_range",
+            "recent_ships_max_range",
+            "Maximum range of recently observed ships",
+        ),
+        (
+            "observed_by_range",
+            "recent_ships_by_range",
+            "Number of recently observed ships within a range, in meters, of the receiver",
+        ),
+        (
+            "max_range_by_direction",
+            "recent_ships_max_range_by_direction",
+            "Maximum range of recently observed ships by direction relative to receiver",
+        ),
         # (
         #     "messages_total",
         #     "messages_total",
         #     "Number of Mode-S messages processed since start up",
         # ),
-        (
-            "lat",
-            "lat",
-            "Latitude of a ship",
-        ),
-        (
-            "lon",
-            "lon",
-            "Longitude of a ship",
-        ),
         # (
         #     "alt",
         #     "alt",
         #     "Altitude of an ships",
         # ),
-        (
-            "heading",
-            "heading",
-            "Heading of a ship",
-        ),
     ),
     "stats": {
         # top level items not in a sub-group are listed under this empty key.
@@ -1,18 +1,37 @@
 import asyncio
+import inspect
+import json
 import logging
+import unittest
 from pathlib import Path
 from typing import Optional
 
 import asynctest
+import numpy as np
 from aiohttp import ClientSession, web
-from aioprometheus import REGISTRY
+from aioprometheus import REGISTRY, histogram
 
-import aisexporter.exporter
-import aisexporter.metrics
 from aisexporter import aisexporter
+from aisexporter.exporter import (
+    COUNTRY_IDX,
+    LAT_IDX,
+    LON_IDX,
+    RANGE_BUCKETS,
+    SEEN_IDX,
+    Position,
+    compass_points,
+    haversine_distance,
+    haversine_vector,
+    range_bucket_counts,
+    relative_angle,
+    relative_direction,
+    relative_direction_from_pos,
+    relative_direction_vector,
+)
+from aisexporter.metrics import Specs
 
 GOLDEN_DATA_DIR = Path(__file__).parent / "golden-data"
-ships_DATA_FILE = GOLDEN_DATA_DIR / "ships.json"
+SHIPS_DATA_FILE = GOLDEN_DATA_DIR / "ships_array.json"
 STATS_DATA_FILE = GOLDEN_DATA_DIR / "stats.json"
 RECEIVER_DATA_FILE = GOLDEN_DATA_DIR / "receiver.json"
 TEST_ORIGIN = (-34.928500, 138.600700)  # (lat, lon)
@@ -25,8 +44,8 @@ class aisServiceEmulator:
         self._runner = None  # type: Optional[web.AppRunner]
         self.url = None  # type: Optional[str]
         self.paths = {
-            "/ships.json": ships_DATA_FILE,
-            "/stats.json": STATS_DATA_FILE,
+            "/ships_array.json": SHIPS_DATA_FILE,
+            "/stat.json": STATS_DATA_FILE,
             "/receiver.json": RECEIVER_DATA_FILE,
         }
 
@@ -57,6 +76,144 @@ class aisServiceEmulator:
         await self._runner.cleanup()
 
 
+class TestDistance(unittest.TestCase):  # pylint: disable=missing-class-docstring
+    def test_haversine_vector(self):
+        """Check vectorised distances match the scalar calculation"""
+        origin = Position(*TEST_ORIGIN)
+        targets = [(-33.9, 138.6), (-34.9285, 139.6), (-35.9, 137.1), (51.5, -0.1)]
+        lats = np.array([lat for lat, _lon in targets])
+        lons = np.array([lon for _lat, lon in targets])
+        distances = haversine_vector(origin.latitude, origin.longitude, lats, lons)
+        for target, distance in zip(targets, distances):
+            expected = haversine_distance(origin, Position(*target))
+            self.assertAlmostEqual(expected, distance, places=3)
+
+    def test_relative_direction_vector(self):
+        """Check vectorised directions match the scalar classification"""
+        origin = Position(*TEST_ORIGIN)
+        bearings = np.radians(np.arange(0.5, 360.0, 5.0))
+        # include a target at the origin itself, which must classify as N
+        lats = np.append(origin.latitude + np.cos(bearings), origin.latitude)
+        lons = np.append(origin.longitude + np.sin(bearings), origin.longitude)
+        indices = relative_direction_vector(
+            origin.latitude, origin.longitude, lats, lons
+        )
+        for lat, lon, index in zip(lats, lons, indices):
+            target = Position(lat, lon)
+            direction = relative_direction(relative_angle(origin, target))
+            self.assertEqual(direction, compass_points[index])
+            self.assertEqual(direction, relative_direction_from_pos(origin, target))
+
+    def test_range_bucket_counts(self):
+        """Check batched range counts match observing each value in turn"""
+        # include values exactly on bucket bounds, which belong to that bucket
+        distances = np.array([0.0, 999.9, 1e3, 1500.0, 50e3, 123456.7, 200e3, 250e3])
+        expected = histogram.Histogram(*RANGE_BUCKETS)
+        for distance in distances:
+            expected.observe(float(distance))
+
+        counts = range_bucket_counts(distances)
+        self.assertEqual(
+            [expected.buckets[bound] for bound in RANGE_BUCKETS], counts.tolist()
+        )
+        self.assertEqual(
+            [0] * len(RANGE_BUCKETS), range_bucket_counts(np.array([])).tolist()
+        )
+
+
+class TestProcessShips(unittest.TestCase):  # pylint: disable=missing-class-docstring
+    def setUp(self):
+        with SHIPS_DATA_FILE.open("rt") as f:
+            self.ships = json.load(f)
+        self.exporter = aisexporter(
+            resource_path=str(GOLDEN_DATA_DIR), origin=TEST_ORIGIN
+        )
+        self.metrics = self.exporter.metrics["ships"]
+
+    def tearDown(self):
+        REGISTRY.clear()
+
+    def get(self, name, **labels):
+        """Return the value of a ships metric for the given labels"""
+        return self.metrics[name].get({"time_period": "latest", **labels})
+
+    def test_process_ships(self):
+        """Check ships data is aggregated into the ships metrics"""
+        self.exporter.process_ships(self.ships)
+
+        # The last fixture row was heard 1200 seconds ago and is excluded by
+        # the default threshold. One of the remaining ships has no position.
+        self.assertEqual(self.get("observed"), 8)
+        self.assertEqual(self.get("observed_with_pos"), 7)
+        self.assertEqual(
+            dict(
+                (labels["country"], value)
+                for labels, value in self.metrics["observed_by_country"].get_all()
+            ),
+            {"AU": 5, "HK": 1, "LR": 1, "unknown": 1},
+        )
+
+        threshold = (
+            inspect.signature(aisexporter.process_ships).parameters["threshold"].default
+        )
+        origin = Position(*TEST_ORIGIN)
+        positions = [
+            Position(a[LAT_IDX], a[LON_IDX])
+            for a in self.ships["values"]
+            if a[SEEN_IDX] <= threshold
+            and a[LAT_IDX] is not None
+            and a[LON_IDX] is not None
+        ]
+        distances = [haversine_distance(origin, position) for position in positions]
+        self.assertAlmostEqual(self.get("max_range"), max(distances), places=3)
+        for direction in compass_points:
+            in_direction = [
+                distance
+                for position, distance in zip(positions, distances)
+                if relative_direction_from_pos(origin, position) == direction
+            ]
+            self.assertAlmostEqual(
+                self.get("max_range_by_direction", direction=direction),
+                max(in_direction, default=0.0),
+                places=3,
+            )
+        for bound in RANGE_BUCKETS:
+            self.assertEqual(
+                self.get("observed_by_range", within_meters=f"{bound:g}"),
+                sum(1 for distance in distances if distance <= bound),
+            )
+
+    def test_threshold(self):
+        """Check only ships seen within the threshold are processed"""
+        self.exporter.process_ships(self.ships, threshold=30)
+        self.assertEqual(self.get("observed"), 5)
+        self.assertEqual(self.get("observed_with_pos"), 4)
+
+        self.exporter.process_ships(self.ships, threshold=5000)
+        self.assertEqual(self.get("observed"), 9)
+        self.assertEqual(self.get("observed_by_country", country="MH"), 1)
+
+    def test_countries_cleared(self):
+        """Check countries that are no longer observed are removed"""
+        self.exporter.process_ships(self.ships)
+        self.assertEqual(self.get("observed_by_country", country="HK"), 1)
+
+        ships = {"values": [a for a in self.ships["values"] if a[COUNTRY_IDX] == "AU"]}
+        self.exporter.process_ships(ships)
+        by_country = self.metrics["observed_by_country"].get_all()
+        self.assertEqual([labels["country"] for labels, _ in by_country], ["AU"])
+
+    def test_no_origin(self):
+        """Check range metrics are not exported without an origin"""
+        REGISTRY.clear()
+        exporter = aisexporter(resource_path=str(GOLDEN_DATA_DIR))
+        exporter.process_ships(self.ships)
+        metrics = exporter.metrics["ships"]
+        self.assertEqual(metrics["observed"].get({"time_period": "latest"}), 8)
+        for name in ("max_range", "max_range_by_direction", "observed_by_range"):
+            self.assertEqual(metrics[name].get_all(), [])
+
+
 class TestExporter(asynctest.TestCase):  # pylint: disable=missing-class-docstring
     def tearDown(self):
         REGISTRY.clear()
@@ -85,12 +242,10 @@ class TestExporter(asynctest.TestCase):  # pylint: disable=missing-class-docstri
                     data = await resp.text()
 
             # Check that expected metrics are present in the response
-            specs = aisexporter.metrics.Specs
-            for _attr, label, _doc in specs["ships"]:
+            # Statistics are not parsed for AIS-catcher yet, so only the
+            # ships metrics are expected.
+            for _attr, label, _doc in Specs["ships"]:
                 self.assertIn(f"{de.prefix}{label}{{", data)
-            for _group_name, group_metrics in specs["stats"].items():
-                for _attr, label, _doc in group_metrics:
-                    self.assertIn(f"{de.prefix}{label}{{", data)
 
             await de.stop()
 